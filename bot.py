@@ -5,13 +5,27 @@ Telegram Bot with SambaNova AI
 Version: 1.1.0 (Stable)
 """
 
+import asyncio
+import atexit
 import os
 import logging
-import requests
-from datetime import timedelta
+import queue
+from logging.handlers import QueueHandler, QueueListener
+import httpx
+import orjson
+import tiktoken
+from cachetools import LRUCache, TTLCache
+from hyperloglog import HyperLogLog
+from redis import asyncio as aioredis
+from redis.exceptions import WatchError
+from prometheus_client import Counter as PromCounter, start_http_server
 import time
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from collections import Counter, deque
+from contextlib import aclosing
+from typing import AsyncIterator
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     MessageHandler,
@@ -24,27 +38,78 @@ from telegram.ext import (
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 SAMBANOVA_API_KEY = os.getenv("SAMBANOVA_API_KEY")
+REDIS_URL = os.getenv("REDIS_URL")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+PORT = int(os.getenv("PORT", "8443"))
+METRICS_PORT = os.getenv("METRICS_PORT")
+METRICS_FLUSH_INTERVAL = 15
 SAMBANOVA_URL = "https://api.sambanova.ai/v1/chat/completions"
 DEFAULT_MODEL = "Meta-Llama-3.1-70B-Instruct"
+MAX_HISTORY = 20
+MAX_HISTORY_TOKENS = 8000
+MAX_USERS = 10_000
+USER_IDLE_TTL = 3600
+COMPACT_LOCK_TTL = 60
+MAX_MESSAGE_LENGTH = 4096
+STREAM_EDIT_INTERVAL = 1.0
+STREAM_EDIT_CHARS = 200
+
+# Sent byte-identical at the head of every request so the provider can reuse
+# its prompt cache for the conversation prefix. Do not make it dynamic.
+SYSTEM_PROMPT = {
+    "role": "system",
+    "content": "You are a helpful AI assistant. Support English, Hindi, and Hinglish. Be friendly and concise."
+}
+SUMMARY_PROMPT = {
+    "role": "system",
+    "content": "Summarize the conversation below in 2-3 sentences. Keep names, facts and preferences the assistant should remember."
+}
+_HEADERS = {
+    "Authorization": f"Bearer {SAMBANOVA_API_KEY}",
+    "Content-Type": "application/json"
+}
 
 # ==================== LOGGING ====================
 
+# Records are queued and written from a listener thread so slow stdout
+# never blocks the event loop
+_log_queue = queue.SimpleQueue()
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+    level=logging.INFO,
+    handlers=[QueueHandler(_log_queue)]
 )
+log_listener = QueueListener(_log_queue, logging.StreamHandler())
+log_listener.start()
+atexit.register(log_listener.stop)
+# httpx logs every request at INFO, including the bot token in Telegram URLs
+logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 # ==================== STORAGE ====================
 
-user_conversations = {}
-user_models = {}
+# cl100k is not the Llama tokenizer but is a close enough proxy for budgeting
+tokenizer = tiktoken.get_encoding("cl100k_base")
+
+user_conversations = LRUCache(maxsize=MAX_USERS)
+user_models = LRUCache(maxsize=MAX_USERS)
+user_summaries = LRUCache(maxsize=MAX_USERS)
+_compacting = set()
+_background_tasks = set()
+user_last_seen = TTLCache(maxsize=MAX_USERS, ttl=USER_IDLE_TTL)
 bot_stats = {
     "start_time": time.time(),
-    "total_messages": 0,
-    "total_users": set(),
-    "errors": 0
+    "total_users": HyperLogLog(0.01)
 }
+_metrics = Counter()
+_flush_task = None
+
+_prom_messages = PromCounter("bot_messages_total", "Text messages handled")
+_prom_errors = PromCounter("bot_errors_total", "Errors by kind", ["kind"])
+
+http_client = None
+redis_client = None
 
 MODELS = {
     "fast": "Meta-Llama-3.1-8B-Instruct",
@@ -52,84 +117,345 @@ MODELS = {
     "powerful": "Meta-Llama-3.1-405B-Instruct"
 }
 
+# ==================== SESSION STORE ====================
+
+async def get_user_model(user_id: int) -> str:
+    """Get the user's selected model"""
+    if redis_client is not None:
+        model = await redis_client.get(f"model:{user_id}")
+        return model.decode() if model else DEFAULT_MODEL
+    return user_models.get(user_id, DEFAULT_MODEL)
+
+async def set_user_model(user_id: int, model: str):
+    """Store the user's selected model (history is kept as-is)"""
+    if redis_client is not None:
+        await redis_client.set(f"model:{user_id}", model, ex=USER_IDLE_TTL)
+    else:
+        user_models[user_id] = model
+
+async def clear_history(user_id: int) -> int:
+    """Delete the user's history, returning how many messages were removed"""
+    if redis_client is not None:
+        async with redis_client.pipeline() as pipe:
+            count, _ = await (
+                pipe.llen(f"conv:{user_id}")
+                .delete(f"conv:{user_id}", f"summary:{user_id}")
+                .execute()
+            )
+        return count
+    user_summaries.pop(user_id, None)
+    conversation = user_conversations.pop(user_id, None)
+    return len(conversation) if conversation else 0
+
+async def summarize_history(summary: str | None, turns: list) -> str | None:
+    """Fold old turns into the running summary using the fast model, or None on failure"""
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in turns)
+    if summary:
+        transcript = f"Earlier summary: {summary}\n\n{transcript}"
+    
+    try:
+        response = await http_client.post(
+            SAMBANOVA_URL,
+            headers=_HEADERS,
+            content=orjson.dumps({
+                "model": MODELS["fast"],
+                "messages": [SUMMARY_PROMPT, {"role": "user", "content": transcript}],
+                "temperature": 0,
+                "max_tokens": 200
+            })
+        )
+        response.raise_for_status()
+        return orjson.loads(response.content)['choices'][0]['message']['content'].strip()
+    except (httpx.HTTPError, orjson.JSONDecodeError, KeyError, IndexError) as e:
+        logger.warning(f"Summary Error: {e}")
+        return None
+
+def compaction_size(entries) -> int:
+    """How many of the oldest entries to fold into the summary"""
+    # Start while there is headroom left for another exchange, then fold
+    # down to half so summaries are rewritten rarely rather than every turn
+    total = sum(tokens for tokens, _ in entries)
+    if len(entries) < MAX_HISTORY - 2 and total <= MAX_HISTORY_TOKENS * 3 // 4:
+        return 0
+    
+    count = 0
+    remaining = len(entries)
+    while remaining > 2 and (remaining > MAX_HISTORY // 2 or total > MAX_HISTORY_TOKENS // 2):
+        total -= entries[count][0]
+        count += 1
+        remaining -= 1
+    return count
+
+async def compact_redis_history(user_id: int):
+    """Redis side of compact_history; caller holds the compaction lock"""
+    key = f"conv:{user_id}"
+    summary_key = f"summary:{user_id}"
+    async with redis_client.pipeline(transaction=False) as pipe:
+        history, summary = await pipe.lrange(key, 0, -1).get(summary_key).execute()
+    entries = [orjson.loads(m) for m in history]
+    count = compaction_size(entries)
+    if not count:
+        return
+    summary = await summarize_history(
+        summary.decode() if summary else None,
+        [m for _, m in entries[:count]]
+    )
+    if summary is None:
+        return
+    
+    # Only trim if the summarized head is still in place, i.e. no /reset
+    # or other writer replaced it while the summary was being generated
+    async with redis_client.pipeline() as pipe:
+        try:
+            await pipe.watch(key, summary_key)
+            if await pipe.lrange(key, 0, count - 1) != history[:count]:
+                return
+            pipe.multi()
+            pipe.ltrim(key, count, -1)
+            pipe.set(summary_key, summary, ex=USER_IDLE_TTL)
+            await pipe.execute()
+        except WatchError:
+            pass
+
+async def compact_history(user_id: int):
+    """Fold the oldest stored turns into the user's running summary"""
+    if user_id in _compacting:
+        return
+    _compacting.add(user_id)
+    try:
+        if redis_client is not None:
+            # Shared lock so only one replica compacts a user at a time
+            lock = f"compact:{user_id}"
+            if not await redis_client.set(lock, 1, nx=True, ex=COMPACT_LOCK_TTL):
+                return
+            try:
+                await compact_redis_history(user_id)
+            finally:
+                await redis_client.delete(lock)
+        else:
+            conversation = user_conversations.get(user_id)
+            count = compaction_size(conversation or ())
+            if not count:
+                return
+            oldest = [conversation[i] for i in range(count)]
+            summary = await summarize_history(user_summaries.get(user_id), [m for _, m in oldest])
+            
+            # Keep the turns if summarizing failed or the user reset meanwhile
+            if summary is None or user_conversations.get(user_id) is not conversation:
+                return
+            user_summaries[user_id] = summary
+            for entry in oldest:
+                if conversation and conversation[0] is entry:
+                    conversation.popleft()
+    except Exception as e:
+        logger.warning(f"Compaction Error: {e}")
+    finally:
+        _compacting.discard(user_id)
+
+def schedule_compaction(user_id: int):
+    """Compact history in the background so it never delays a reply"""
+    task = asyncio.create_task(compact_history(user_id))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
 # ==================== AI RESPONSE ====================
 
-def get_ai_response(user_id: int, message: str) -> str:
-    """Get AI response from SambaNova"""
+def count_tokens(msg: dict) -> int:
+    """Approximate token count of a message's content"""
+    return len(tokenizer.encode_ordinary(msg["content"]))
+
+def fit_token_budget(turns) -> list:
+    """Newest messages whose combined size fits MAX_HISTORY_TOKENS"""
+    # Compaction keeps stored history well under budget; this only trims
+    # when a single oversized new message pushes the request over it
+    kept = []
+    total = 0
+    for tokens, msg in reversed(turns):
+        total += tokens
+        if total > MAX_HISTORY_TOKENS and kept:
+            break
+        kept.append(msg)
+    kept.reverse()
+    return kept
+
+async def get_ai_response(user_id: int, message: str) -> AsyncIterator[str]:
+    """Stream AI response chunks from SambaNova"""
+    parts = []
+    conversation = None
+    user_msg = {
+        "role": "user",
+        "content": message
+    }
+    user_entry = (count_tokens(user_msg), user_msg)
     try:
-        if user_id not in user_conversations:
-            user_conversations[user_id] = []
-        
-        if user_id not in user_models:
-            user_models[user_id] = DEFAULT_MODEL
-        
-        user_conversations[user_id].append({
-            "role": "user",
-            "content": message
-        })
-        
-        if len(user_conversations[user_id]) > 20:
-            user_conversations[user_id] = user_conversations[user_id][-20:]
+        if redis_client is not None:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                history, model, summary = await (
+                    pipe.lrange(f"conv:{user_id}", 0, -1)
+                    .get(f"model:{user_id}")
+                    .get(f"summary:{user_id}")
+                    .execute()
+                )
+            history = [orjson.loads(m) for m in history]
+            model = model.decode() if model else DEFAULT_MODEL
+            summary = summary.decode() if summary else None
+            turns = [*history, user_entry]
+        else:
+            for idle_id, _ in user_last_seen.expire():
+                user_conversations.pop(idle_id, None)
+                user_models.pop(idle_id, None)
+                user_summaries.pop(idle_id, None)
+            user_last_seen[user_id] = time.time()
+            
+            conversation = user_conversations.get(user_id)
+            if conversation is None:
+                conversation = user_conversations[user_id] = deque(maxlen=MAX_HISTORY)
+            
+            model = user_models.get(user_id)
+            if model is None:
+                model = user_models[user_id] = DEFAULT_MODEL
+            summary = user_summaries.get(user_id)
+            
+            conversation.append(user_entry)
+            turns = conversation
         
-        system_prompt = {
-            "role": "system",
-            "content": "You are a helpful AI assistant. Support English, Hindi, and Hinglish. Be friendly and concise."
-        }
+        # Prefix is stable between compactions: new turns are appended at the
+        # end, and the history head and summary change only when a background
+        # compaction folds old turns (or a single oversized message forces
+        # fit_token_budget to trim)
+        if summary:
+            summary_msg = {
+                "role": "system",
+                "content": f"[Earlier conversation summary: {summary}]"
+            }
+            messages = [SYSTEM_PROMPT, summary_msg, *fit_token_budget(turns)]
+        else:
+            messages = [SYSTEM_PROMPT, *fit_token_budget(turns)]
         
-        response = requests.post(
+        async with http_client.stream(
+            "POST",
             SAMBANOVA_URL,
-            headers={
-                "Authorization": f"Bearer {SAMBANOVA_API_KEY}",
-                "Content-Type": "application/json"
-            },
-            json={
-                "model": user_models[user_id],
-                "messages": [system_prompt] + user_conversations[user_id],
+            headers=_HEADERS,
+            content=orjson.dumps({
+                "model": model,
+                "messages": messages,
                 "temperature": 0.7,
-                "max_tokens": 1500
-            },
-            timeout=30
-        )
-        
-        if response.status_code == 200:
-            ai_message = response.json()['choices'][0]['message']['content']
-            user_conversations[user_id].append({
-                "role": "assistant",
-                "content": ai_message
+                "max_tokens": 1500,
+                "stream": True
             })
-            return ai_message
+        ) as response:
+            if response.status_code != 200:
+                _metrics["err_api"] += 1
+                yield f"⚠️ API Error {response.status_code}. Please try again!"
+                return
+            
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                event = orjson.loads(data)
+                if "error" in event:
+                    error = event["error"]
+                    _metrics["err_api"] += 1
+                    logger.error(f"Stream Error: {error}")
+                    detail = error.get("message", "") if isinstance(error, dict) else str(error)
+                    yield ("\n\n" if parts else "") + f"⚠️ API Error: {detail or 'unknown'}. Please try again!"
+                    return
+                choices = event.get("choices")
+                if not choices:
+                    continue
+                delta = choices[0].get("delta", {}).get("content")
+                if delta:
+                    parts.append(delta)
+                    yield delta
+        
+        if not parts:
+            _metrics["err_api"] += 1
+            yield "⚠️ Empty response. Please try again!"
+            return
+        
+        assistant_msg = {
+            "role": "assistant",
+            "content": "".join(parts)
+        }
+        assistant_entry = (count_tokens(assistant_msg), assistant_msg)
+        if conversation is not None:
+            conversation.append(assistant_entry)
+            stored = conversation
         else:
-            bot_stats["errors"] += 1
-            return f"⚠️ API Error {response.status_code}. Please try again!"
+            key = f"conv:{user_id}"
+            async with redis_client.pipeline() as pipe:
+                await (
+                    pipe.rpush(key, orjson.dumps(user_entry), orjson.dumps(assistant_entry))
+                    .ltrim(key, -MAX_HISTORY, -1)
+                    .expire(key, USER_IDLE_TTL)
+                    .expire(f"summary:{user_id}", USER_IDLE_TTL)
+                    .expire(f"model:{user_id}", USER_IDLE_TTL)
+                    .execute()
+                )
+            stored = [*turns, assistant_entry]
+        
+        # Fold old turns into the summary instead of dropping them
+        if compaction_size(stored):
+            schedule_compaction(user_id)
     
-    except requests.exceptions.Timeout:
-        bot_stats["errors"] += 1
-        return "⏱️ Timeout! Please try again."
+    except httpx.TimeoutException:
+        _metrics["err_timeout"] += 1
+        yield ("\n\n" if parts else "") + "⏱️ Timeout! Please try again."
+    
+    except httpx.HTTPError as e:
+        _metrics["err_api"] += 1
+        logger.error(f"HTTP Error: {e}")
+        yield ("\n\n" if parts else "") + "⚠️ Connection error. Please try again!"
     
     except Exception as e:
-        bot_stats["errors"] += 1
+        _metrics["err_other"] += 1
         logger.error(f"AI Error: {e}")
-        return f"❌ Error: {str(e)}"
+        yield ("\n\n" if parts else "") + f"❌ Error: {str(e)}"
+    
+    finally:
+        # Don't leave an unanswered user turn behind on failure
+        if conversation and conversation[-1] is user_entry:
+            conversation.pop()
+
+async def stream_reply(message: Message, chunks: AsyncIterator[str]):
+    """Send streamed text as progressive message edits"""
+    reply = await message.reply_text("…")
+    text = shown = ""
+    last_edit = time.monotonic()
+    
+    async with aclosing(chunks):
+        async for chunk in chunks:
+            text += chunk
+            
+            # Roll over to a new message once Telegram's length limit is hit
+            while len(text) > MAX_MESSAGE_LENGTH:
+                head, text = text[:MAX_MESSAGE_LENGTH], text[MAX_MESSAGE_LENGTH:]
+                if head != shown:
+                    await reply.edit_text(head)
+                shown = text[:MAX_MESSAGE_LENGTH]
+                reply = await message.reply_text(shown if shown.strip() else "…")
+                last_edit = time.monotonic()
+            
+            if (
+                text.strip()
+                and len(text) - len(shown) >= STREAM_EDIT_CHARS
+                and time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL
+            ):
+                await reply.edit_text(text)
+                shown = text
+                last_edit = time.monotonic()
+    
+    if not text.strip():
+        await reply.delete()
+    elif text != shown:
+        await reply.edit_text(text)
 
-# ==================== COMMAND HANDLERS ====================
+# ==================== STATIC CONTENT ====================
 
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle /start"""
-    try:
-        user_name = update.effective_user.first_name or "User"
-        
-        keyboard = [
-            [
-                InlineKeyboardButton("💬 Chat", callback_data='chat'),
-                InlineKeyboardButton("ℹ️ Help", callback_data='help')
-            ],
-            [
-                InlineKeyboardButton("🤖 Model", callback_data='models'),
-                InlineKeyboardButton("📊 Stats", callback_data='stats')
-            ]
-        ]
-        
-        text = f"""👋 **Hi {user_name}!**
+_START_TEXT = """👋 **Hi {user_name}!**
 
 🤖 AI Bot powered by SambaNova
 
@@ -146,19 +472,8 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /stats - Statistics
 
 Just send any message to chat!"""
-        
-        await update.message.reply_text(
-            text,
-            parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-    except Exception as e:
-        logger.error(f"Start error: {e}")
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle /help"""
-    try:
-        text = """🆘 **Help Menu**
+_HELP_TEXT = """🆘 **Help Menu**
 
 **Commands:**
 /start - Welcome message
@@ -177,11 +492,55 @@ Just send any message!
 
 **Languages:**
 🇬🇧 English | 🇮🇳 Hindi | 🔄 Hinglish"""
+
+_MODEL_TEXT = """🤖 **Model Selection**
+
+Current: {current}
+
+⚡ Fast - Quick responses
+⚖️ Balanced - Default
+💪 Powerful - Best quality
+
+Choose:"""
+
+_START_KEYBOARD_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("💬 Chat", callback_data='chat'),
+        InlineKeyboardButton("ℹ️ Help", callback_data='help')
+    ],
+    [
+        InlineKeyboardButton("🤖 Model", callback_data='models'),
+        InlineKeyboardButton("📊 Stats", callback_data='stats')
+    ]
+])
+
+_MODEL_KEYBOARD_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("⚡ Fast (8B)", callback_data='model_fast')],
+    [InlineKeyboardButton("⚖️ Balanced (70B)", callback_data='model_balanced')],
+    [InlineKeyboardButton("💪 Powerful (405B)", callback_data='model_powerful')]
+])
+
+_stats_cache = TTLCache(maxsize=1, ttl=1)
+
+# ==================== COMMAND HANDLERS ====================
+
+async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /start"""
+    try:
+        user_name = update.effective_user.first_name or "User"
         
-        if update.message:
-            await update.message.reply_text(text, parse_mode='Markdown')
-        elif update.callback_query:
-            await update.callback_query.message.reply_text(text, parse_mode='Markdown')
+        await update.message.reply_text(
+            _START_TEXT.format(user_name=user_name),
+            parse_mode='Markdown',
+            reply_markup=_START_KEYBOARD_MARKUP
+        )
+    except Exception as e:
+        logger.error(f"Start error: {e}")
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /help"""
+    try:
+        await update.effective_message.reply_text(_HELP_TEXT, parse_mode='Markdown')
     except Exception as e:
         logger.error(f"Help error: {e}")
 
@@ -190,17 +549,13 @@ async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = update.effective_user.id
         
-        if user_id in user_conversations:
-            count = len(user_conversations[user_id])
-            del user_conversations[user_id]
+        count = await clear_history(user_id)
+        if count:
             text = f"✅ Cleared {count} messages!"
         else:
             text = "💭 No history to clear."
         
-        if update.message:
-            await update.message.reply_text(text)
-        elif update.callback_query:
-            await update.callback_query.message.reply_text(text)
+        await update.effective_message.reply_text(text)
     except Exception as e:
         logger.error(f"Reset error: {e}")
 
@@ -208,59 +563,40 @@ async def model_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /model"""
     try:
         user_id = update.effective_user.id
-        current = user_models.get(user_id, DEFAULT_MODEL)
+        current = await get_user_model(user_id)
         
-        keyboard = [
-            [InlineKeyboardButton("⚡ Fast (8B)", callback_data='model_fast')],
-            [InlineKeyboardButton("⚖️ Balanced (70B)", callback_data='model_balanced')],
-            [InlineKeyboardButton("💪 Powerful (405B)", callback_data='model_powerful')]
-        ]
-        
-        text = f"""🤖 **Model Selection**
-
-Current: {current}
-
-⚡ Fast - Quick responses
-⚖️ Balanced - Default
-💪 Powerful - Best quality
-
-Choose:"""
+        text = _MODEL_TEXT.format(current=current)
         
-        if update.message:
-            await update.message.reply_text(
-                text,
-                parse_mode='Markdown',
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-        elif update.callback_query:
-            await update.callback_query.message.reply_text(
-                text,
-                parse_mode='Markdown',
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
+        await update.effective_message.reply_text(
+            text,
+            parse_mode='Markdown',
+            reply_markup=_MODEL_KEYBOARD_MARKUP
+        )
     except Exception as e:
         logger.error(f"Model error: {e}")
 
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /stats"""
     try:
-        uptime = str(timedelta(seconds=int(time.time() - bot_stats["start_time"])))
-        
-        text = f"""📊 **Statistics**
+        text = _stats_cache.get(None)
+        if text is None:
+            h, r = divmod(int(time.time() - bot_stats["start_time"]), 3600)
+            m, sec = divmod(r, 60)
+            uptime = f"{h}:{m:02d}:{sec:02d}"
+            # Conversations live in Redis then, so the local count is meaningless
+            active = "" if redis_client is not None else f"\n🧠 Active: {len(user_conversations)}"
+            
+            text = _stats_cache[None] = f"""📊 **Statistics**
 
 ⏱️ Uptime: {uptime}
 👥 Users: {len(bot_stats['total_users'])}
-💬 Messages: {bot_stats['total_messages']}
-🧠 Active: {len(user_conversations)}
-❌ Errors: {bot_stats['errors']}
+💬 Messages: {_metrics['messages']}{active}
+❌ Errors: {_metrics['err_timeout'] + _metrics['err_api'] + _metrics['err_other']}
 
 🚀 Version: 1.1.0
 ⚡ Status: Online"""
         
-        if update.message:
-            await update.message.reply_text(text, parse_mode='Markdown')
-        elif update.callback_query:
-            await update.callback_query.message.reply_text(text, parse_mode='Markdown')
+        await update.effective_message.reply_text(text, parse_mode='Markdown')
     except Exception as e:
         logger.error(f"Stats error: {e}")
 
@@ -272,18 +608,16 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
         user_message = update.message.text
         
-        bot_stats["total_users"].add(user_id)
-        bot_stats["total_messages"] += 1
+        bot_stats["total_users"].add(str(user_id))
+        _metrics["messages"] += 1
         
-        logger.info(f"User {user_id}: {user_message[:30]}...")
+        logger.debug("User %s: %.30s...", user_id, user_message)
         
         await update.message.chat.send_action(action="typing")
         
-        ai_response = get_ai_response(user_id, user_message)
-        
-        await update.message.reply_text(ai_response)
+        await stream_reply(update.message, get_ai_response(user_id, user_message))
         
-        logger.info(f"Bot replied to {user_id}")
+        logger.debug("Bot replied to %s", user_id)
     except Exception as e:
         logger.error(f"Message error: {e}")
         try:
@@ -316,7 +650,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         elif data.startswith('model_'):
             model_type = data.split('_')[1]
-            user_models[user_id] = MODELS[model_type]
+            await set_user_model(user_id, MODELS[model_type])
             await query.message.reply_text(
                 f"✅ Model changed to {MODELS[model_type]}!"
             )
@@ -328,10 +662,45 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Global error handler"""
     logger.error(f"Update {update} caused error: {context.error}")
-    bot_stats["errors"] += 1
+    _metrics["err_other"] += 1
+
+# ==================== METRICS ====================
+
+async def flush_metrics():
+    """Periodically push metric deltas to Prometheus counters"""
+    flushed = Counter()
+    while True:
+        await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+        snapshot = _metrics.copy()
+        for key, value in snapshot.items():
+            delta = value - flushed[key]
+            if not delta:
+                continue
+            if key == "messages":
+                _prom_messages.inc(delta)
+            else:
+                _prom_errors.labels(kind=key.removeprefix("err_")).inc(delta)
+        flushed = snapshot
 
 # ==================== MAIN ====================
 
+async def post_init(app: Application):
+    """Start background metrics export"""
+    global _flush_task
+    if METRICS_PORT:
+        start_http_server(int(METRICS_PORT))
+        _flush_task = asyncio.create_task(flush_metrics())
+        logger.info(f"📈 Metrics on port {METRICS_PORT}")
+
+async def post_shutdown(app: Application):
+    """Stop metrics export and close shared HTTP and Redis clients"""
+    if _flush_task is not None:
+        _flush_task.cancel()
+    if http_client is not None:
+        await http_client.aclose()
+    if redis_client is not None:
+        await redis_client.aclose()
+
 def main():
     """Main function"""
     if not TELEGRAM_TOKEN:
@@ -342,9 +711,34 @@ def main():
         logger.error("❌ No SAMBANOVA_API_KEY!")
         return
     
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        logger.error("❌ WEBHOOK_URL requires WEBHOOK_SECRET!")
+        return
+    
     logger.info("✨ Starting bot...")
     
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
+    global http_client, redis_client
+    http_client = httpx.AsyncClient(
+        timeout=30.0,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+    )
+    
+    if REDIS_URL:
+        redis_client = aioredis.from_url(REDIS_URL)
+        logger.info("🗄️ Using Redis session store")
+    
+    app = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .rate_limiter(AIORateLimiter(overall_max_rate=30, overall_time_period=1, max_retries=3))
+        .connection_pool_size(256)
+        .pool_timeout(30)
+        .get_updates_connection_pool_size(16)
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Commands
     app.add_handler(CommandHandler("start", start_command))
@@ -363,7 +757,18 @@ def main():
     app.add_error_handler(error_handler)
     
     logger.info("🚀 Bot running!")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        url_path = f"telegram/{WEBHOOK_SECRET}"
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=url_path,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{url_path}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES
+        )
+    else:
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file